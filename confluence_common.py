@@ -0,0 +1,115 @@
+# confluence_common.py
+# Helpers shared by the Confluence attachment scripts: HTTP session, _publish.yml lookup, auth/base-url resolution
+
+import os, re, json, atexit, requests, typer, yaml
+from typing import Optional, Dict, Any, Tuple, NoReturn, Callable
+from urllib.parse import urlsplit
+from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pathlib import Path
+from functools import lru_cache
+from importlib.util import find_spec
+_loads: Callable[[Any], Any]
+_dumps: Callable[[Any], str]
+try:
+    import orjson  # faster JSON parsing/serialisation when installed
+    _loads = orjson.loads
+    _dumps = lambda o: orjson.dumps(o, option=orjson.OPT_INDENT_2).decode()
+except ImportError:
+    _loads = json.loads
+    _dumps = lambda o: json.dumps(o, indent=2)
+try: from yaml import CSafeLoader as _Loader  # libyaml-backed, much faster
+except ImportError: from yaml import SafeLoader as _Loader  # type: ignore[assignment]
+
+# ---- shared HTTP session (keep-alive + connection pool across calls)
+_SESSION = requests.Session()
+# raise_on_status=False: once retries run out, hand back the last response so callers can report its HTTP status.
+# POST is not retried: uploads stream a body that cannot be rewound, and attachment creation is not idempotent.
+_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=20, max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429,500,502,503,504], allowed_methods=["GET","DELETE"], respect_retry_after_header=True, raise_on_status=False))
+for _scheme in ("https://", "http://"): _SESSION.mount(_scheme, _ADAPTER)
+_SESSION.headers.update({"Accept": "application/json", "User-Agent": "confluence-attachment-tool/1.0", "Connection": "keep-alive"})
+# urllib3 can only decode "br" bodies when a brotli package is installed
+_SESSION.headers["Accept-Encoding"] = "gzip, br, deflate" if (find_spec("brotli") or find_spec("brotlicffi")) else "gzip, deflate"
+atexit.register(_SESSION.close)
+
+# ---- helpers
+def fail(message: str, code: int = 2) -> NoReturn:
+    typer.echo(message, err=True)
+    raise typer.Exit(code=code)
+#
+_PAGES_RE = re.compile(r"/pages/(\d+)")
+def env_or_die(k: str) -> str:
+    v = os.environ.get(k)
+    if not v: fail(f"ERROR: environment variable {k} is not set.")
+    return v
+#
+@lru_cache(maxsize=1024)
+def infer_base_url_from_page_url(page_url: str) -> Optional[str]:
+    if not page_url: return None
+    parts = urlsplit(page_url)
+    ctx = ""
+    for c in ("/wiki", "/confluence"):
+        if parts.path.startswith(c): ctx = c; break
+    return f"{parts.scheme}://{parts.netloc}{ctx}" if parts.scheme and parts.netloc else None
+#
+@lru_cache(maxsize=1024)
+def _norm(p: str) -> str:
+    return os.path.basename(os.path.normpath(p))
+#
+def _load_publish(publish_path: Path) -> Tuple[Any, Dict[str, Any]]:
+    """Parse _publish.yml into (data, {normalized source: entry}), reusing a sibling JSON cache stamped with the YAML's exact mtime and size."""
+    cache = publish_path.with_suffix(".yml.cache.json")
+    st = publish_path.stat()
+    stamp = [st.st_mtime_ns, st.st_size]  # exact match, so a YAML copied in with an older mtime is still re-read
+    try:
+        if cache.exists():
+            c = _loads(cache.read_bytes())
+            if isinstance(c, dict) and c.get("stamp") == stamp and "index" in c: return c["data"], c["index"]
+    except (OSError, ValueError): pass
+    with publish_path.open("r") as f:
+        data = yaml.load(f, Loader=_Loader)
+    index: Dict[str, Any] = {}
+    if isinstance(data, list):
+        for e in data:
+            if isinstance(e, dict): index.setdefault(_norm(e.get("source", "")), e)
+    try: cache.write_text(json.dumps({"stamp": stamp, "data": data, "index": index}))
+    except (OSError, TypeError, ValueError): pass  # cache is best-effort (read-only dir, non-JSON YAML types)
+    return data, index
+#
+def get_page_from_publish(publish_path: Path, source_qmd: str) -> Dict[str, Optional[str]]:
+    # Key on mtime and size so an edited or replaced _publish.yml is never served stale
+    st = publish_path.stat()
+    return dict(_get_page_from_publish(str(publish_path), st.st_mtime_ns, st.st_size, source_qmd))
+#
+@lru_cache(maxsize=128)
+def _get_page_from_publish(publish_file: str, mtime_ns: int, size: int, source_qmd: str) -> Dict[str, Optional[str]]:
+    publish_path = Path(publish_file)
+    data, index = _load_publish(publish_path)
+    if not isinstance(data, list):
+        fail(f"Unexpected structure in {publish_path}: expected a top-level list.")
+    entry = index.get(_norm(source_qmd))
+    if entry is not None:
+        cfg = entry.get("confluence")
+        item = (cfg[0] if isinstance(cfg, list) and cfg else cfg) if cfg else None
+        if not isinstance(item, dict):
+            fail(f"No 'confluence' config for source {source_qmd} in {publish_path}.")
+        page_id = str(item.get("id") or "").strip()
+        page_url = item.get("url")
+        if not page_id and page_url:
+            m = _PAGES_RE.search(page_url)
+            if m: page_id = m.group(1)
+        if not page_id:
+            fail(f"Could not find page id for {source_qmd} in {publish_path}.")
+        return {"id": page_id, "url": page_url}
+    fail(f"Source {source_qmd} not found in {publish_path}.")
+#
+def make_auth(email: Optional[str], token: Optional[str]) -> HTTPBasicAuth:
+    em = email or env_or_die("CONFLUENCE_EMAIL")
+    tk = token or env_or_die("CONFLUENCE_API_TOKEN")
+    return HTTPBasicAuth(em, tk)
+#
+def resolve_base_url(cli_base_url: Optional[str], page_url: Optional[str]) -> str:
+    base = cli_base_url or os.environ.get("CONFLUENCE_BASE_URL") or infer_base_url_from_page_url(page_url or "")
+    if not base: fail("Cannot determine CONFLUENCE_BASE_URL (pass --base-url or set env, or include url in _publish.yml).")
+    return base.rstrip("/")
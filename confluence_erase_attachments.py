@@ -3,105 +3,122 @@
 # Script to list/delete Confluence attachments using _publish.yml
 # Author: Fred Gruber
 
-import os, re, json, requests, typer, yaml
+import requests, typer
 from typing import Optional, Iterable, Dict, Any, List
-from urllib.parse import urlsplit
 from requests.auth import HTTPBasicAuth
 from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from confluence_common import _SESSION, _loads, _dumps, get_page_from_publish, make_auth, resolve_base_url
 
 app = typer.Typer(add_completion=False, help="Manage Confluence page attachments via _publish.yml")
 
 # ---- helpers
-def env_or_die(k: str) -> str:
-    v = os.environ.get(k)
-    if not v: raise typer.Exit(code=2, message=f"ERROR: environment variable {k} is not set.")
-    return v
+def _next_url(base_url: str, links: Dict[str, Any]) -> Optional[str]:
+    """Absolute URL for _links.next, which may be absolute, relative to base, or already carry the /wiki context."""
+    nxt = links.get("next")
+    if not nxt or nxt.startswith("http"): return nxt
+    ctx = links.get("context") or ""
+    if ctx and base_url.endswith(ctx) and nxt.startswith(ctx + "/"): nxt = nxt[len(ctx):]
+    return f"{base_url}{nxt}"
 #
-def infer_base_url_from_page_url(page_url: str) -> Optional[str]:
-    if not page_url: return None
-    parts = urlsplit(page_url)
-    ctx = ""
-    for c in ("/wiki", "/confluence"):
-        if parts.path.startswith(c): ctx = c; break
-    return f"{parts.scheme}://{parts.netloc}{ctx}" if parts.scheme and parts.netloc else None
+def iter_attachments(base_url: str, page_id: str, auth: HTTPBasicAuth, limit: int = 200, expand: str = "version,extensions") -> Iterable[dict]:
+    # First page is built from params; later pages follow the server's _links.next verbatim.
+    # The next page is requested in the background before the current page's items are yielded.
+    url = f"{base_url}/rest/api/content/{page_id}/child/attachment"
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        fut: Optional[Future] = ex.submit(_SESSION.get, url, auth=auth, params={"start": 0, "limit": limit, "expand": expand})
+        try:
+            while fut is not None:
+                r = fut.result()
+                r.raise_for_status()
+                data = _loads(r.content)
+                nxt = _next_url(base_url, data.get("_links") or {})
+                fut = ex.submit(_SESSION.get, nxt, auth=auth) if nxt else None
+                yield from data.get("results", [])
+        finally:
+            if fut is not None: fut.cancel()
 #
-def _norm(p: str) -> str:
-    return os.path.basename(os.path.normpath(p))
+def _format_attachment(base_url: str, att: dict) -> Dict[str, Any]:
+    ext = att.get("extensions") or {}
+    ver = att.get("version") or {}
+    links = att.get("_links") or {}
+    return {
+        "id": att.get("id"),
+        "title": att.get("title",""),
+        "mediaType": ext.get("mediaType"),
+        "fileSize": ext.get("fileSize"),
+        "version": ver.get("number"),
+        "created": ver.get("when"),
+        "creator": (ver.get("by") or {}).get("displayName"),
+        "download": f'{base_url}{links.get("download")}' if links.get("download") else None,
+        "webui": f'{base_url}{links.get("webui")}' if links.get("webui") else None,
+    }
 #
-def get_page_from_publish(publish_path: Path, source_qmd: str) -> Dict[str, Optional[str]]:
-    with publish_path.open("r") as f:
-        data = yaml.safe_load(f)
-    if not isinstance(data, list):
-        raise typer.Exit(code=2, message=f"Unexpected structure in {publish_path}: expected a top-level list.")
-    target = _norm(source_qmd)
-    for entry in data:
-        if not isinstance(entry, dict): continue
-        if _norm(entry.get("source","")) != target: continue
-        cfg = entry.get("confluence")
-        item = (cfg[0] if isinstance(cfg, list) and cfg else cfg) if cfg else None
-        if not isinstance(item, dict):
-            raise typer.Exit(code=2, message=f"No 'confluence' config for source {source_qmd} in {publish_path}.")
-        page_id = str(item.get("id") or "").strip()
-        page_url = item.get("url")
-        if not page_id and page_url:
-            m = re.search(r"/pages/(\d+)", page_url)
-            if m: page_id = m.group(1)
-        if not page_id:
-            raise typer.Exit(code=2, message=f"Could not find page id for {source_qmd} in {publish_path}.")
-        return {"id": page_id, "url": page_url}
-    raise typer.Exit(code=2, message=f"Source {source_qmd} not found in {publish_path}.")
-#
-def make_auth(email: Optional[str], token: Optional[str]) -> HTTPBasicAuth:
-    em = email or env_or_die("CONFLUENCE_EMAIL")
-    tk = token or env_or_die("CONFLUENCE_API_TOKEN")
-    return HTTPBasicAuth(em, tk)
-#
-def resolve_base_url(cli_base_url: Optional[str], page_url: Optional[str]) -> str:
-    base = cli_base_url or os.environ.get("CONFLUENCE_BASE_URL") or infer_base_url_from_page_url(page_url or "")
-    if not base: raise typer.Exit(code=2, message="Cannot determine CONFLUENCE_BASE_URL (pass --base-url or set env, or include url in _publish.yml).")
-    return base.rstrip("/")
-#
-def iter_attachments(base_url: str, page_id: str, auth: HTTPBasicAuth, limit: int = 50) -> Iterable[dict]:
-    start = 0
-    while True:
-        url = f"{base_url}/rest/api/content/{page_id}/child/attachment"
-        r = requests.get(url, auth=auth, params={"start": start, "limit": limit, "expand": "version,extensions,metadata"})
+def stream_page_attachments(base_url: str, page_id: str, auth: HTTPBasicAuth, filename_contains: Optional[str] = None, expand: str = "version,extensions", limit: int = 200, exact: bool = False) -> Iterable[Dict[str, Any]]:
+    """Yield formatted attachment rows as each page of results arrives."""
+    if exact and filename_contains:
+        # Exact filename: let the server filter in a single request instead of paginating everything
+        r = _SESSION.get(f"{base_url}/rest/api/content/{page_id}/child/attachment", auth=auth, params={"filename": filename_contains, "expand": expand})
         r.raise_for_status()
-        data = r.json()
-        for att in data.get("results", []): yield att
-        if (data.get("_links") or {}).get("next"): start += limit
-        else: break
+        for att in _loads(r.content).get("results", []):
+            if att.get("title") == filename_contains: yield _format_attachment(base_url, att)
+        return
+    for att in iter_attachments(base_url, page_id, auth, limit=limit, expand=expand):
+        if filename_contains and filename_contains not in att.get("title",""): continue
+        yield _format_attachment(base_url, att)
 #
-def list_page_attachments(base_url: str, page_id: str, auth: HTTPBasicAuth, filename_contains: Optional[str] = None) -> List[Dict[str, Any]]:
-    items: List[Dict[str, Any]] = []
-    for att in iter_attachments(base_url, page_id, auth):
-        title = att.get("title","")
-        if filename_contains and filename_contains not in title: continue
-        ext = att.get("extensions") or {}
-        ver = att.get("version") or {}
-        links = att.get("_links") or {}
-        items.append({
-            "id": att.get("id"),
-            "title": title,
-            "mediaType": ext.get("mediaType"),
-            "fileSize": ext.get("fileSize"),
-            "version": ver.get("number"),
-            "created": ver.get("when"),
-            "creator": (ver.get("by") or {}).get("displayName"),
-            "download": f'{base_url}{links.get("download")}' if links.get("download") else None,
-            "webui": f'{base_url}{links.get("webui")}' if links.get("webui") else None,
-        })
-    return items
+def list_page_attachments(base_url: str, page_id: str, auth: HTTPBasicAuth, filename_contains: Optional[str] = None, expand: str = "version,extensions", limit: int = 200, exact: bool = False) -> List[Dict[str, Any]]:
+    return list(stream_page_attachments(base_url, page_id, auth, filename_contains=filename_contains, expand=expand, limit=limit, exact=exact))
 #
 def delete_attachment(base_url: str, attachment_id: str, auth: HTTPBasicAuth) -> requests.Response:
-    return requests.delete(f"{base_url}/rest/api/content/{attachment_id}", auth=auth)
+    """DELETE an attachment without buffering its body (stream=True); the caller must close the response."""
+    r = _SESSION.delete(f"{base_url}/rest/api/content/{attachment_id}", auth=auth, stream=True)
+    # Discard the (empty) success body here, in the worker, so the connection is back in the pool before its next request
+    if r.status_code in (204,200): r.raw.drain_conn()
+    return r
 #
+_UNITS = ("B","KB","MB","GB","TB")
 def human(n: Optional[int]) -> str:
     if n is None: return ""
-    s = float(n)
-    for u in ("B","KB","MB","GB","TB"):
-        if s < 1024 or u == "TB": return f"{s:.1f} {u}"
-        s /= 1024
+    if n <= 0: return f"{float(n):.1f} B"
+    k = min((int(n).bit_length()-1)//10, len(_UNITS)-1)  # floor(log1024(n)) without a loop
+    return f"{n/(1<<(10*k)):.1f} {_UNITS[k]}"
+#
+def _echo_table(rows: Iterable[Dict[str, Any]]) -> int:
+    """Print attachments as a table; returns the number of rows (nothing is printed for zero)."""
+    # Truncate titles and track the widest one in the same pass that builds the rows
+    table: List[tuple] = []
+    title_w = 20
+    for a in rows:
+        title = a["title"] if len(a["title"])<=60 else a["title"][:57]+"..."
+        if len(title) > title_w: title_w = len(title)
+        table.append((a["id"], title, human(a["fileSize"]), str(a["mediaType"])[:24], str(a["version"]), a["creator"], a["created"]))
+    if not table: return 0
+    typer.echo(f"{'ID':<12}  {'Title':<{title_w}}  {'Size':>9}  {'Type':<24}  Ver    Creator    Updated")
+    for aid, title, size, mtype, ver, creator, created in table:
+        typer.echo(f"{aid:<12}  {title:<{title_w}}  {size:>9}  {mtype:<24}  {ver:>3}  {creator} {created}")
+    return len(table)
+#
+def _delete_all(base_url: str, atts: List[Dict[str, Any]], auth: HTTPBasicAuth, concurrency: int) -> int:
+    """Delete attachments in parallel over the shared session, echoing each result; returns the failure count."""
+    failures = 0
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(atts))) as ex:
+        futures = {ex.submit(delete_attachment, base_url, a["id"], auth): a for a in atts}
+        for fut in as_completed(futures):
+            a = futures[fut]
+            try: r = fut.result()
+            except requests.RequestException as e:
+                failures += 1
+                typer.echo(f"❌ Failed [{a['id']}] {a['title']} — {e}")
+                continue
+            with r:  # only the status matters on success; the body is read just for error reports
+                if r.status_code in (204,200): typer.echo(f"✅ Deleted [{a['id']}] {a['title']}")
+                else:
+                    failures += 1
+                    typer.echo(f"❌ Failed [{a['id']}] {a['title']} — HTTP {r.status_code}")
+                    try: typer.echo(r.text)
+                    except Exception: pass
+    return failures
 
 # ---- commands
 @app.command("show-page", help="Resolve page info from _publish.yml for a given source .qmd")
@@ -111,13 +128,15 @@ def show_page(
 ):
     info = get_page_from_publish(publish, str(source))
     base_url = resolve_base_url(None, info["url"])
-    typer.echo(json.dumps({"page_id": info["id"], "page_url": info["url"], "base_url": base_url}, indent=2))
+    typer.echo(_dumps({"page_id": info["id"], "page_url": info["url"], "base_url": base_url}))
 
 @app.command("list", help="List all attachments on the Confluence page mapped from the .qmd in _publish.yml")
 def list_cmd(
     source: Path = typer.Argument(..., help="Source .qmd (key in _publish.yml)"),
     publish: Path = typer.Option(Path("_publish.yml"), "--publish", "-p", help="Path to _publish.yml"),
     filename_contains: Optional[str] = typer.Option(None, "--contains", "-c", help="Filter by substring in filename"),
+    exact: bool = typer.Option(False, "--exact", help="Treat --contains as an exact filename (single server-side lookup)"),
+    page_size: int = typer.Option(200, "--page-size", min=1, max=200, help="Attachments fetched per API request"),
     output: str = typer.Option("table", "--output", "-o", help="table|tsv|json", case_sensitive=False),
     base_url: Optional[str] = typer.Option(None, "--base-url", help="Override CONFLUENCE_BASE_URL"),
     email: Optional[str] = typer.Option(None, "--email", help="Override CONFLUENCE_EMAIL"),
@@ -125,41 +144,39 @@ def list_cmd(
 ):
     info = get_page_from_publish(publish, str(source))
     auth = make_auth(email, token)
+    _SESSION.auth = auth
     b = resolve_base_url(base_url, info["url"])
-    atts = list_page_attachments(b, info["id"], auth, filename_contains=filename_contains)
-    if output.lower() == "json":
-        typer.echo(json.dumps(atts, indent=2))
-        raise typer.Exit()
+    rows = stream_page_attachments(b, info["id"], auth, filename_contains=filename_contains, limit=page_size, exact=exact)
     if output.lower() == "tsv":
+        # Print each row as soon as its page of results arrives
         typer.echo("id\ttitle\tfileSize\tmediaType\tversion\tcreator\tcreated\tdownload")
-        for a in atts:
+        for a in rows:
             typer.echo(f"{a['id']}\t{a['title']}\t{a['fileSize']}\t{a['mediaType']}\t{a['version']}\t{a['creator']}\t{a['created']}\t{a['download']}")
         raise typer.Exit()
-    # table
-    if not atts:
-        typer.echo("No attachments found.")
+    if output.lower() == "json":
+        typer.echo(_dumps(list(rows)))
         raise typer.Exit()
-    w = max(len(a["title"]) for a in atts)
-    typer.echo(f"{'ID':<12}  {'Title':<{min(60,max(20,min(w,60)))}}  {'Size':>50}  {'Type':<24}  Ver    Creator    Updated")
-    for a in atts:
-        title = a["title"] if len(a["title"])<=60 else a["title"][:57]+"..."
-        typer.echo(f"{a['id']:<12}  {title:<60}  {human(a['fileSize']):>9}  {str(a['mediaType'])[:24]:<24}  {str(a['version']):>3}  {a['creator']} {a['created']}")
+    if _echo_table(rows) == 0: typer.echo("No attachments found.")
 
 @app.command("delete", help="Delete attachments on the mapped page (dry-run by default)")
 def delete_cmd(
     source: Path = typer.Argument(..., help="Source .qmd (key in _publish.yml)"),
     publish: Path = typer.Option(Path("_publish.yml"), "--publish", "-p", help="Path to _publish.yml"),
     filename_contains: Optional[str] = typer.Option(None, "--contains", "-c", help="Filter by substring in filename"),
+    exact: bool = typer.Option(False, "--exact", help="Treat --contains as an exact filename (single server-side lookup)"),
+    page_size: int = typer.Option(200, "--page-size", min=1, max=200, help="Attachments fetched per API request"),
     dry_run: bool = typer.Option(True, "--dry-run/--no-dry-run", help="Preview deletions instead of performing them"),
     yes: bool = typer.Option(False, "--yes", "-y", help="Skip confirmation prompt when not dry-run"),
+    concurrency: int = typer.Option(8, "--concurrency", min=1, max=20, help="Number of parallel delete requests"),
     base_url: Optional[str] = typer.Option(None, "--base-url", help="Override CONFLUENCE_BASE_URL"),
     email: Optional[str] = typer.Option(None, "--email", help="Override CONFLUENCE_EMAIL"),
     token: Optional[str] = typer.Option(None, "--token", help="Override CONFLUENCE_API_TOKEN"),
 ):
     info = get_page_from_publish(publish, str(source))
     auth = make_auth(email, token)
+    _SESSION.auth = auth
     b = resolve_base_url(base_url, info["url"])
-    atts = list_page_attachments(b, info["id"], auth, filename_contains=filename_contains)
+    atts = list_page_attachments(b, info["id"], auth, filename_contains=filename_contains, limit=page_size, exact=exact)
     if not atts:
         typer.echo("No attachments matched.")
         raise typer.Exit()
@@ -171,15 +188,35 @@ def delete_cmd(
         raise typer.Exit()
     if not yes:
         if not typer.confirm("Proceed to delete the attachments above?"): raise typer.Exit(code=1)
-    failures = 0
-    for a in atts:
-        r = delete_attachment(b, a["id"], auth)
-        if r.status_code in (204,200): typer.echo(f"✅ Deleted [{a['id']}] {a['title']}")
-        else:
-            failures += 1
-            typer.echo(f"❌ Failed [{a['id']}] {a['title']} — HTTP {r.status_code}")
-            try: typer.echo(r.text)
-            except Exception: pass
+    failures = _delete_all(b, atts, auth, concurrency)
+    if failures==0: typer.echo("\nAll deletions succeeded.")
+    else: typer.echo(f"\nCompleted with {failures} failure(s).")
+
+@app.command("purge", help="List matching attachments and delete them in one run (one HTTP session, one listing)")
+def purge_cmd(
+    source: Path = typer.Argument(..., help="Source .qmd (key in _publish.yml)"),
+    publish: Path = typer.Option(Path("_publish.yml"), "--publish", "-p", help="Path to _publish.yml"),
+    filename_contains: Optional[str] = typer.Option(None, "--contains", "-c", help="Filter by substring in filename"),
+    exact: bool = typer.Option(False, "--exact", help="Treat --contains as an exact filename (single server-side lookup)"),
+    page_size: int = typer.Option(200, "--page-size", min=1, max=200, help="Attachments fetched per API request"),
+    yes: bool = typer.Option(False, "--yes", "-y", help="Skip confirmation prompt"),
+    concurrency: int = typer.Option(8, "--concurrency", min=1, max=20, help="Number of parallel delete requests"),
+    base_url: Optional[str] = typer.Option(None, "--base-url", help="Override CONFLUENCE_BASE_URL"),
+    email: Optional[str] = typer.Option(None, "--email", help="Override CONFLUENCE_EMAIL"),
+    token: Optional[str] = typer.Option(None, "--token", help="Override CONFLUENCE_API_TOKEN"),
+):
+    info = get_page_from_publish(publish, str(source))
+    auth = make_auth(email, token)
+    _SESSION.auth = auth
+    b = resolve_base_url(base_url, info["url"])
+    # The listing shown is exactly what gets deleted: no second fetch between confirm and delete
+    atts = list_page_attachments(b, info["id"], auth, filename_contains=filename_contains, limit=page_size, exact=exact)
+    if _echo_table(atts) == 0:
+        typer.echo("No attachments matched.")
+        raise typer.Exit()
+    if not yes:
+        if not typer.confirm(f"\nDelete these {len(atts)} attachment(s) from page {info['id']}?"): raise typer.Exit(code=1)
+    failures = _delete_all(b, atts, auth, concurrency)
     if failures==0: typer.echo("\nAll deletions succeeded.")
     else: typer.echo(f"\nCompleted with {failures} failure(s).")
 
@@ -2,72 +2,36 @@
 # confluence_update_attachment.py
 # Update (or optionally create) a Confluence attachment using _publish.yml mapping
 
-import os, re, sys, json, requests, typer, yaml
+import requests, typer
 from pathlib import Path
 from typing import Optional, Dict, Any
-from urllib.parse import urlsplit
 from requests.auth import HTTPBasicAuth
+try: from requests_toolbelt.multipart.encoder import MultipartEncoder  # streams uploads instead of buffering
+except ImportError: MultipartEncoder = None
+from confluence_common import _SESSION, _loads, fail, get_page_from_publish, make_auth, resolve_base_url
 
 app = typer.Typer(add_completion=False, help="Update a Confluence attachment (figure) from a local file")
 
 # ---- helpers
-def env_or_die(k: str) -> str:
-    v = os.environ.get(k)
-    if not v:
-        raise typer.Exit(code=2, message=f"ERROR: environment variable {k} is not set.")
-    return v
-def infer_base_url_from_page_url(page_url: str) -> Optional[str]:
-    if not page_url: return None
-    parts = urlsplit(page_url)
-    ctx = ""
-    for c in ("/wiki", "/confluence"):
-        if parts.path.startswith(c): ctx = c; break
-    return f"{parts.scheme}://{parts.netloc}{ctx}" if parts.scheme and parts.netloc else None
-def _norm(p: str) -> str:
-    return os.path.basename(os.path.normpath(p))
-def get_page_from_publish(publish_path: Path, source_qmd: str) -> Dict[str, Optional[str]]:
-    with publish_path.open("r") as f:
-        data = yaml.safe_load(f)
-    if not isinstance(data, list):
-        raise typer.Exit(code=2, message=f"Unexpected structure in {publish_path}: expected a top-level list.")
-    target = _norm(source_qmd)
-    for entry in data:
-        if not isinstance(entry, dict): continue
-        if _norm(entry.get("source", "")) != target: continue
-        cfg = entry.get("confluence")
-        item = (cfg[0] if isinstance(cfg, list) and cfg else cfg) if cfg else None
-        if not isinstance(item, dict):
-            raise typer.Exit(code=2, message=f"No 'confluence' config for source {source_qmd} in {publish_path}.")
-        page_id = str(item.get("id") or "").strip()
-        page_url = item.get("url")
-        if not page_id and page_url:
-            m = re.search(r"/pages/(\d+)", page_url)
-            if m: page_id = m.group(1)
-        if not page_id:
-            raise typer.Exit(code=2, message=f"Could not find page id for {source_qmd} in {publish_path}.")
-        return {"id": page_id, "url": page_url}
-    raise typer.Exit(code=2, message=f"Source {source_qmd} not found in {publish_path}.")
-def make_auth(email: Optional[str], token: Optional[str]) -> HTTPBasicAuth:
-    em = email or env_or_die("CONFLUENCE_EMAIL")
-    tk = token or env_or_die("CONFLUENCE_API_TOKEN")
-    return HTTPBasicAuth(em, tk)
-def resolve_base_url(cli_base_url: Optional[str], page_url: Optional[str]) -> str:
-    base = cli_base_url or os.environ.get("CONFLUENCE_BASE_URL") or infer_base_url_from_page_url(page_url or "")
-    if not base:
-        raise typer.Exit(code=2, message="Cannot determine CONFLUENCE_BASE_URL (pass --base-url or set env, or include url in _publish.yml).")
-    return base.rstrip("/")
 def get_headers(no_check: bool=True) -> Dict[str, str]:
     h = {}
     if no_check: h["X-Atlassian-Token"] = "nocheck"  # required for multipart upload/update
     return h
 
 # ---- API helpers
+def _post_file(url: str, upload_name: str, file_path: Path, auth: HTTPBasicAuth, params: Dict[str, str]) -> requests.Response:
+    """Multipart-POST a file, streaming it from disk when requests-toolbelt is installed."""
+    with file_path.open("rb") as f:
+        if MultipartEncoder is None:
+            return _SESSION.post(url, auth=auth, headers=get_headers(), params=params, files={"file": (upload_name, f)})
+        m = MultipartEncoder(fields={"file": (upload_name, f, "application/octet-stream")})
+        return _SESSION.post(url, auth=auth, headers={**get_headers(), "Content-Type": m.content_type}, params=params, data=m)
 def lookup_attachment_by_name(base_url: str, page_id: str, auth: HTTPBasicAuth, filename: str) -> Optional[Dict[str, Any]]:
     """Return the attachment content object for a given filename (latest version if multiple)."""
     url = f"{base_url}/rest/api/content/{page_id}/child/attachment"
-    r = requests.get(url, auth=auth, params={"filename": filename, "expand": "version,extensions,metadata"})
+    r = _SESSION.get(url, auth=auth, params={"filename": filename, "expand": "version,extensions"})
     r.raise_for_status()
-    results = r.json().get("results", [])
+    results = _loads(r.content).get("results", [])
     if not results: return None
     # Pick the highest version if multiple entries somehow exist
     results.sort(key=lambda a: (a.get("version") or {}).get("number", 0), reverse=True)
@@ -77,23 +41,19 @@ def update_attachment(base_url: str, page_id: str, attachment_id: str, upload_na
     url = f"{base_url}/rest/api/content/{page_id}/child/attachment/{attachment_id}/data"
     params = {}
     if comment: params["comment"] = comment  # optional version comment
-    with file_path.open("rb") as f:
-        files = {"file": (upload_name, f)}
-        r = requests.post(url, auth=auth, headers=get_headers(), params=params, files=files)
+    r = _post_file(url, upload_name, file_path, auth, params)
     if r.status_code != 200:
-        raise typer.Exit(code=1, message=f"Update failed (HTTP {r.status_code}): {r.text}")
-    return r.json()
+        fail(f"Update failed (HTTP {r.status_code}): {r.text}", code=1)
+    return _loads(r.content)
 def create_attachment(base_url: str, page_id: str, upload_name: str, file_path: Path, auth: HTTPBasicAuth, comment: Optional[str]=None) -> Dict[str, Any]:
     """POST a new attachment to the page."""
     url = f"{base_url}/rest/api/content/{page_id}/child/attachment"
     params = {}
     if comment: params["comment"] = comment
-    with file_path.open("rb") as f:
-        files = {"file": (upload_name, f)}
-        r = requests.post(url, auth=auth, headers=get_headers(), params=params, files=files)
+    r = _post_file(url, upload_name, file_path, auth, params)
     if r.status_code not in (200, 201):
-        raise typer.Exit(code=1, message=f"Create failed (HTTP {r.status_code}): {r.text}")
-    return r.json()
+        fail(f"Create failed (HTTP {r.status_code}): {r.text}", code=1)
+    return _loads(r.content)
 
 # ---- CLI
 @app.command("update", help="Update an existing attachment on the page mapped from the .qmd in _publish.yml")
@@ -105,6 +65,7 @@ def update_cmd(
     attachment_id: Optional[str] = typer.Option(None, "--attachment-id", help="Attachment ID to update (skips filename lookup)"),
     comment: Optional[str] = typer.Option(None, "--comment", help="Optional version comment"),
     create_if_missing: bool = typer.Option(False, "--create-if-missing/--fail-if-missing", help="Create the attachment if not found by name"),
+    fetch_title: bool = typer.Option(False, "--fetch-title/--no-fetch-title", help="With --attachment-id and --name, still GET the attachment to use its current server title"),
     dry_run: bool = typer.Option(False, "--dry-run", help="Show what would happen without uploading"),
     base_url: Optional[str] = typer.Option(None, "--base-url", help="Override CONFLUENCE_BASE_URL"),
     email: Optional[str] = typer.Option(None, "--email", help="Override CONFLUENCE_EMAIL"),
@@ -113,6 +74,7 @@ def update_cmd(
 ):
     info = get_page_from_publish(publish, str(source))
     auth = make_auth(email, token)
+    _SESSION.auth = auth
     b = resolve_base_url(base_url, info["url"])
     upload_name = attachment_name or file.name
 
@@ -122,22 +84,25 @@ def update_cmd(
 
     # Resolve attachment
     att_obj = None
-    if attachment_id:
+    if attachment_id and attachment_name and not fetch_title:
+        # Caller supplied both id and name: trust them and skip the extra round-trip
+        att_obj = {"id": attachment_id, "title": attachment_name}
+    elif attachment_id:
         # Minimal fetch for context/title
         url = f"{b}/rest/api/content/{attachment_id}"
-        r = requests.get(url, auth=auth, params={"expand": "version"})
+        r = _SESSION.get(url, auth=auth, params={"expand": "version"})
         if r.status_code == 200:
-            att_obj = r.json()
+            att_obj = _loads(r.content)
             # Prefer server title for upload name to avoid accidental rename
             upload_name = att_obj.get("title") or upload_name
         else:
-            raise typer.Exit(code=2, message=f"Attachment id {attachment_id} not accessible (HTTP {r.status_code}).")
+            fail(f"Attachment id {attachment_id} not accessible (HTTP {r.status_code}).")
     else:
         att_obj = lookup_attachment_by_name(b, info["id"], auth, upload_name)
 
     if not att_obj:
         if not create_if_missing:
-            raise typer.Exit(code=3, message=f"Attachment '{upload_name}' not found on page {info['id']}. Use --create-if-missing to upload new.")
+            fail(f"Attachment '{upload_name}' not found on page {info['id']}. Use --create-if-missing to upload new.", code=3)
         if dry_run:
             typer.echo(f"[dry-run] Would CREATE new attachment '{upload_name}' on page {info['id']} from '{file}'.")
             raise typer.Exit()